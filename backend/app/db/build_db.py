@@ -1,21 +1,44 @@
 import pymupdf
 import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+_worker_doc = None
+
+def _open_worker_doc(pdf_path):
+    # pymupdf documents can't be pickled, so each worker process opens its own handle once
+    global _worker_doc
+    _worker_doc = pymupdf.open(pdf_path)
+
+def _extract_block(page_nums):
+    return [_worker_doc[page_num].get_text() for page_num in page_nums]
 
 def extract_text_from_pdf(pdf_path):
     print('starting to extract text from pdf')
     all_text = []
 
     with pymupdf.open(pdf_path) as doc:
-        for page in doc:
-            text = page.get_text() 
+        n_pages = len(doc)
+
+    # hand each worker one contiguous block of pages instead of one page per task
+    n_workers = min(os.cpu_count() or 1, 6)
+    block_size = max(1, -(-n_pages // n_workers))
+    blocks = [range(start, min(start + block_size, n_pages)) for start in range(0, n_pages, block_size)]
+
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             initializer=_open_worker_doc, initargs=(pdf_path,)) as executor:
+        results = itertools.chain.from_iterable(executor.map(_extract_block, blocks))
+
+        for page_num, text in enumerate(results):
             if text: 
                 all_text.append({
                     "page_content": text,
-                    "metadata": {"source": "Oxford Handbook", "page": page.number + 1}
+                    "metadata": {"source": "Oxford Handbook", "page": page_num + 1}
                 })
 
     print(f'finished extracting text from pdf, the total number of pages is {len(all_text)}')
     return all_text
 
 
-extract_text_from_pdf('assets/oxford.pdf')
+if __name__ == "__main__":
+    extract_text_from_pdf('assets/oxford.pdf')
@@ -1,108 +1,271 @@
 
 import os
+import json
+import itertools
+import sqlite3 # To remember finished work between runs
+import hashlib
+import asyncio # To describe many images at once
 import pymupdf  
-from langchain.text_splitter import RecursiveCharacterTextSplitter # To smartly chunk text
+from semantic_text_splitter import TextSplitter # To smartly chunk text (Rust-backed, much faster than pure Python)
 import chromadb # Our vector database ("smart filing cabinet")
+from chromadb.api.types import Documents, EmbeddingFunction
+from chromadb.utils.embedding_functions import register_embedding_function
+import numpy as np # To hand embeddings to ChromaDB as one compact array
 from dotenv import load_dotenv # To securely load our API key
 import google.generativeai as genai # To use Google's Gemini models
-from PIL import Image # To handle image files
 import time # To handle potential API rate limits
+from google.api_core.exceptions import ResourceExhausted # Raised when we hit a Gemini quota (HTTP 429)
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor # To read PDF pages on every CPU core, and save images in the background
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 
 # --- 2. CONFIGURATION: All our settings in one place ---
 
 # -- File Paths --
 PDF_FILE_PATH = "assets/oxford.pdf"  # Updated to correct path
 IMAGE_OUTPUT_FOLDER = "images" # Folder to save extracted pictures
+SAVE_IMAGES = False # Set to True to also keep a copy of every extracted picture in IMAGE_OUTPUT_FOLDER
 DB_PATH = "my_medical_db" # Folder where the final "brain" will be stored
+CACHE_PATH = "cache/build_cache.sqlite3" # Page texts and image descriptions from earlier runs, so reruns skip that work
+CACHE_VERSION = 2 # Bump whenever the cache's table layout changes
 
 # -- AI Model Names --
 EMBEDDING_MODEL = "models/text-embedding-004" # For creating "meaning coordinates"
 VISION_MODEL = "models/gemini-1.5-pro-latest" # For "seeing" and describing images
+VISION_IMAGE_FORMATS = ("png", "jpeg", "webp") # Image formats Gemini Vision reads directly
+EMBEDDING_BATCH_SIZE = 100 # The most texts the embedding API accepts in one request
+
+# -- Text Chunking Settings --
+CHUNK_TOKENIZER = "gpt-3.5-turbo" # Counts tokens with tiktoken's cl100k_base, close enough to Gemini's tokenizer
+CHUNK_SIZE = 500 # Tokens per text card, well inside the embedding model's 2048-token input limit
+CHUNK_OVERLAP = 50 # Tokens shared between neighbouring text cards
 
 # -- Database Settings --
-DB_COLLECTION_NAME = "oxford_multimodal" # The name of our table inside the database
+DB_COLLECTION_NAME = "oxford_multimodal_gemini" # The name of our table inside the database (the older "oxford_multimodal" used ChromaDB's default embeddings)
+
+# -- Parallelism Settings --
+PDF_WORKERS = min(os.cpu_count() or 1, 6) # Extra workers stop helping beyond ~6 cores
+VISION_CONCURRENCY = 16 # How many Gemini Vision requests may be in flight at once
+IMAGE_WRITE_WORKERS = 8 # Threads saving images to disk (file writes release the GIL)
+MAX_PENDING_WRITES = 32 # How many images may wait to be written before extraction pauses
+
+# -- API Rate Limits --
+VISION_RPM = 60 # Gemini Vision requests allowed per minute on our quota
+EMBEDDING_RPM = 1500 # Embedding requests allowed per minute on our quota (each holds up to EMBEDDING_BATCH_SIZE texts)
+MAX_RETRIES = 5 # How many times to retry a request rejected for exceeding the quota
 
 # --- 3. THE BLUEPRINT: Our functions (The Robot's Jobs) ---
 
 def initialize_database():
-    """Sets up the ChromaDB client and creates our collection."""
+    """
+    Sets up the ChromaDB client and creates our collection. Returns both.
+    The collection is tied to GeminiEmbeddingFunction, so it only ever holds (and is searched with)
+    EMBEDDING_MODEL's "meaning coordinates". An existing collection built with anything else stops the build.
+    """
     print("Setting up the database...")
     
     # Create ChromaDB client
     client = chromadb.PersistentClient(path=DB_PATH)
     
+    # Make sure an existing collection was built with the same embedding model before adding to it
+    if DB_COLLECTION_NAME in [c.name for c in client.list_collections()]:
+        existing = client.get_collection(name=DB_COLLECTION_NAME)
+        embedding_function = existing.configuration.get("embedding_function")
+        if not isinstance(embedding_function, GeminiEmbeddingFunction) \
+                or embedding_function.get_config() != GeminiEmbeddingFunction().get_config():
+            name = embedding_function.name() if embedding_function is not None else "none"
+            print(f"ERROR: The collection '{DB_COLLECTION_NAME}' in '{DB_PATH}' was built with the '{name}' embedding function,")
+            print(f"not {EMBEDDING_MODEL}, so its vectors can't be mixed with ours.")
+            print(f"Delete the '{DB_PATH}' folder (or change DB_COLLECTION_NAME) and run the build again.")
+            exit(1)
+    
     # Create or get collection
-    try:
-        collection = client.create_collection(
-            name=DB_COLLECTION_NAME,
-            metadata={"hnsw:space": "cosine"}
-        )
-        print(f"Created new collection: {DB_COLLECTION_NAME}")
-    except Exception:
-        collection = client.get_collection(name=DB_COLLECTION_NAME)
-        print(f"Using existing collection: {DB_COLLECTION_NAME}")
+    collection = client.get_or_create_collection(
+        name=DB_COLLECTION_NAME,
+        embedding_function=GeminiEmbeddingFunction(),
+        metadata={"hnsw:space": "cosine"}
+    )
+    print(f"Using collection: {DB_COLLECTION_NAME} ({collection.count()} items)")
     
-    return collection
+    return client, collection
 
-def extract_text_from_pdf(pdf_path):
+def open_cache(cache_path):
     """
-    Job 1: The Librarian.
-    Reads the PDF and extracts all text, page by page.
-    Returns a list of dictionaries, each with page text and metadata.
+    Opens (or creates) the build cache.
+    It keeps the text and image XREFs of every page, keyed by the PDF's hash, the text extraction flags
+    and the page number, and the Gemini Vision description of every image, keyed by the image's hash,
+    the vision model and the prompt's hash. Changing any of those settings makes the cache miss instead
+    of handing back stale results.
+    A rerun (e.g. after the database step crashed) then doesn't have to parse the PDF or pay for Vision again.
     """
-    print('Starting to extract text from pdf...')
-    all_text = []
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    
+    cache = sqlite3.connect(cache_path)
+    # A cache written with an older table layout is thrown away rather than misread
+    if cache.execute("PRAGMA user_version").fetchone()[0] != CACHE_VERSION:
+        cache.execute("DROP TABLE IF EXISTS pages")
+        cache.execute("DROP TABLE IF EXISTS vision")
+        cache.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+    
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS pages ("
+        "pdf_hash TEXT, text_flags INTEGER, page_num INTEGER, text TEXT, image_xrefs TEXT, "
+        "PRIMARY KEY (pdf_hash, text_flags, page_num))"
+    )
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS vision ("
+        "image_hash TEXT, model TEXT, prompt_hash TEXT, description TEXT, "
+        "PRIMARY KEY (image_hash, model, prompt_hash))"
+    )
+    return cache
 
-    with pymupdf.open(pdf_path) as doc:
-        for page in doc:
-            text = page.get_text() 
-            if text: 
-                all_text.append({
-                    "page_content": text,
-                    "metadata": {"source": "Oxford Handbook", "page": page.number + 1}
-                })
+def hash_file(path):
+    """Returns the BLAKE2b hash of a file, used to recognise a PDF we have already parsed."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
 
-    print(f'Finished extracting text from pdf, the total number of pages is {len(all_text)}')
-    return all_text
+# Plain text only: keep whitespace, join words hyphenated across lines and skip text outside the page
+PAGE_TEXT_FLAGS = pymupdf.TEXT_PRESERVE_WHITESPACE | pymupdf.TEXT_DEHYPHENATE | pymupdf.TEXT_MEDIABOX_CLIP
 
-def extract_images_from_pdf(pdf_path, output_folder):
+# Each worker process keeps its own handle on the PDF (PyMuPDF documents can't be pickled)
+_worker_doc = None
+
+def _open_worker_doc(pdf_path):
+    """Runs once in every worker process so pages don't pay for re-opening the PDF."""
+    global _worker_doc
+    _worker_doc = pymupdf.open(pdf_path)
+
+def _extract_block(page_nums):
+    """Worker helper for extract_pages: returns the text and image XREFs of each page in a block of pages."""
+    results = []
+    for page_num in page_nums:
+        page = _worker_doc[page_num]
+        # full=False skips the extra resource lookups, we only need each image's XREF
+        results.append((page.get_text("text", flags=PAGE_TEXT_FLAGS), [img[0] for img in page.get_images(full=False)]))
+    return results
+
+def _split_into_blocks(page_nums, n_blocks):
+    """Splits a list of page numbers into at most n_blocks contiguous blocks of nearly equal size."""
+    block_size = max(1, -(-len(page_nums) // n_blocks))
+    return [page_nums[i:i + block_size] for i in range(0, len(page_nums), block_size)]
+
+def _extract_image_bytes(doc, xref):
     """
-    Job 2: The Art Curator.
-    Finds all images in the PDF and saves them to a folder.
-    Returns a list of file paths to the saved images.
+    Returns the image's bytes exactly as stored in the PDF, plus their format.
+    Only images in a format Gemini Vision can't read are converted (to PNG).
     """
-    print(f"Extracting images from PDF to {output_folder}...")
+    base_image = doc.extract_image(xref)
+    if base_image["ext"] in VISION_IMAGE_FORMATS:
+        return base_image["image"], base_image["ext"]
+    
+    pixmap = pymupdf.Pixmap(doc, xref)
+    # PNG only holds gray or RGB colors (e.g. CMYK has to be converted first)
+    if pixmap.colorspace and pixmap.colorspace.n > 3:
+        pixmap = pymupdf.Pixmap(pymupdf.csRGB, pixmap)
+    return pixmap.tobytes("png"), "png"
+
+def _save_image(image_path, image_bytes):
+    """Writes one extracted image to disk (runs on a background writer thread)."""
+    with open(image_path, "wb") as f:
+        f.write(image_bytes)
+
+def extract_pages(pdf_path, image_output_folder=None, cache=None):
+    """
+    Jobs 1 & 2: The Librarian and The Art Curator.
+    Reads the PDF once, spreading blocks of pages over PDF_WORKERS processes, and collects both
+    the text of every page and the images on it. The images are also saved to image_output_folder if one is given.
+    An image that appears on several pages (logos, icons, ...) is only extracted once.
+    Pages already in the cache (if one is given) aren't parsed again.
+    Returns the page texts (a list of dictionaries with text and metadata) and the images
+    (a list of dictionaries with the image id, its bytes and MIME type, and every page it appears on).
+    """
+    print("Extracting text and images from PDF...")
     
     # Create output folder if it doesn't exist
-    os.makedirs(output_folder, exist_ok=True)
+    if image_output_folder:
+        os.makedirs(image_output_folder, exist_ok=True)
     
-    image_paths = []
+    text_records = []
+    image_records = []
+    xref_to_image = {} # The same XREF means the same embedded image
     
-    with pymupdf.open(pdf_path) as doc:
+    # Pages parsed by an earlier run of this exact PDF
+    cached_pages = {}
+    new_pages = []
+    if cache is not None:
+        pdf_hash = hash_file(pdf_path)
+        rows = cache.execute(
+            "SELECT page_num, text, image_xrefs FROM pages WHERE pdf_hash = ? AND text_flags = ?",
+            (pdf_hash, PAGE_TEXT_FLAGS)
+        )
+        cached_pages = {page_num: (text, json.loads(xrefs)) for page_num, text, xrefs in rows}
+
+    with pymupdf.open(pdf_path) as doc, \
+            ProcessPoolExecutor(max_workers=PDF_WORKERS, initializer=_open_worker_doc, initargs=(pdf_path,)) as executor, \
+            ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as writer:
+        if cached_pages:
+            print(f"Reusing {len(cached_pages)} of {len(doc)} pages from the cache")
+        
+        # One block of pages per worker, so each task's overhead is paid once per block rather than once per page
+        pages_to_parse = [page_num for page_num in range(len(doc)) if page_num not in cached_pages]
+        blocks = _split_into_blocks(pages_to_parse, PDF_WORKERS)
+        # map() hands results back in page order
+        results = itertools.chain.from_iterable(executor.map(_extract_block, blocks))
+        # Image files are written in the background while we move on to the next page
+        pending_writes = set()
+
         for page_num in range(len(doc)):
-            page = doc[page_num]
-            image_list = page.get_images()
+            if page_num in cached_pages:
+                text, xrefs = cached_pages[page_num]
+            else:
+                text, xrefs = next(results)
+                if cache is not None:
+                    new_pages.append((pdf_hash, PAGE_TEXT_FLAGS, page_num, text, json.dumps(xrefs)))
             
-            for img_index, img in enumerate(image_list):
-                # Get the XREF of the image
-                xref = img[0]
+            if text: 
+                text_records.append({
+                    "page_content": text,
+                    "metadata": {"source": "Oxford Handbook", "page": page_num + 1}
+                })
+            
+            for img_index, xref in enumerate(xrefs):
+                # Already extracted from an earlier page, just remember where else it shows up
+                if xref in xref_to_image:
+                    xref_to_image[xref]["pages"].append(page_num + 1)
+                    continue
                 
                 # Extract the image bytes
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                
-                # Create filename
-                image_filename = f"page_{page_num + 1}_img_{img_index}.png"
-                image_path = os.path.join(output_folder, image_filename)
+                image_id = f"page_{page_num + 1}_img_{img_index}"
+                image_bytes, ext = _extract_image_bytes(doc, xref)
                 
                 # Save the image
-                with open(image_path, "wb") as f:
-                    f.write(image_bytes)
+                if image_output_folder:
+                    # Wait for a write to finish once too many are queued
+                    if len(pending_writes) >= MAX_PENDING_WRITES:
+                        done, pending_writes = wait(pending_writes, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    
+                    image_path = os.path.join(image_output_folder, f"{image_id}.{ext}")
+                    pending_writes.add(writer.submit(_save_image, image_path, image_bytes))
                 
-                image_paths.append(image_path)
+                xref_to_image[xref] = {
+                    "image_id": image_id,
+                    "image_hash": hashlib.blake2b(image_bytes).hexdigest(),
+                    "data": image_bytes,
+                    "mime_type": f"image/{ext}",
+                    "pages": [page_num + 1]
+                }
+                image_records.append(xref_to_image[xref])
+
+        for future in as_completed(pending_writes):
+            future.result()
     
-    print(f"Extracted {len(image_paths)} images")
-    return image_paths
+    if new_pages:
+        cache.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", new_pages)
+        cache.commit()
+
+    print(f"Finished extracting the PDF: {len(text_records)} pages with text, {len(image_records)} unique images")
+    return text_records, image_records
 
 def create_text_cards(text_data):
     """
@@ -112,30 +275,19 @@ def create_text_cards(text_data):
     """
     print("Creating text cards from extracted text...")
     
-    # Initialize the text splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-    )
-    
-    # Combine all text data
-    all_texts = []
-    for item in text_data:
-        all_texts.append({
-            "content": item["page_content"],
-            "metadata": item["metadata"]
-        })
+    # Initialize the text splitter, measuring chunks in tokens so every card makes good use of the embedding model
+    text_splitter = TextSplitter.from_tiktoken_model(CHUNK_TOKENIZER, CHUNK_SIZE, overlap=CHUNK_OVERLAP)
     
     # Split the texts
     text_cards = []
-    for item in all_texts:
+    for item in text_data:
         # Split the content
-        chunks = text_splitter.split_text(item["content"])
+        chunks = text_splitter.chunks(item["page_content"])
         
         # Create cards for each chunk
         for i, chunk in enumerate(chunks):
             text_cards.append({
+                "id": f"page_{item['metadata']['page']}_chunk_{i}",
                 "content": chunk,
                 "metadata": {
                     **item["metadata"],
@@ -147,96 +299,266 @@ def create_text_cards(text_data):
     print(f"Created {len(text_cards)} text cards")
     return text_cards
 
-def create_image_cards(image_paths):
+# Prompt sent along with every image to Gemini Vision
+VISION_PROMPT = """You are a medical expert analyzing a medical image or diagram. 
+            Please provide a detailed description of what you see, including:
+            - Any anatomical structures visible
+            - Medical conditions or symptoms shown
+            - Diagnostic information or measurements
+            - Any text, labels, or captions in the image
+            - The type of medical image (X-ray, diagram, chart, etc.)
+            
+            Be precise and use medical terminology where appropriate."""
+# Cached descriptions are only reused for the same prompt
+VISION_PROMPT_HASH = hashlib.blake2b(VISION_PROMPT.encode()).hexdigest()
+
+class RateLimiter:
+    """
+    A token bucket allowing max_rate requests every time_period seconds.
+    Requests go straight through while tokens are left and only wait once the bucket is empty.
+    Use it with "async with" from asyncio code, or with a plain "with" from regular code.
+    """
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = max_rate
+        self._last_refill = time.monotonic()
+
+    def _take_token(self):
+        """Takes a token and returns 0, or returns how many seconds until the next token if the bucket is empty."""
+        now = time.monotonic()
+        refill = (now - self._last_refill) * self.max_rate / self.time_period
+        self._tokens = min(self.max_rate, self._tokens + refill)
+        self._last_refill = now
+        
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * self.time_period / self.max_rate
+
+    async def __aenter__(self):
+        while (wait := self._take_token()) > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __enter__(self):
+        while (wait := self._take_token()) > 0:
+            time.sleep(wait)
+
+    def __exit__(self, *exc_info):
+        return False
+
+async def _describe_image(vision_model, semaphore, limiter, image, cache):
+    """
+    Asks Gemini Vision to describe one image, waiting for a free slot and a rate limit token first.
+    Backs off exponentially and retries when the API reports that the quota is used up.
+    The description is saved to the cache (if one is given) as soon as it arrives.
+    """
+    # Send the bytes straight from the PDF, there is no need to decode and re-encode the picture
+    image_part = {"mime_type": image["mime_type"], "data": image["data"]}
+    
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with limiter:
+                    response = await vision_model.generate_content_async([VISION_PROMPT, image_part])
+                break
+            except ResourceExhausted:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                wait = min(2 ** attempt, 60)
+                print(f"Vision quota exceeded for {image['image_id']}, retrying in {wait}s...")
+                await asyncio.sleep(wait)
+        
+        print(f"Processed image: {image['image_id']}")
+    
+    if cache is not None:
+        cache.execute(
+            "INSERT OR REPLACE INTO vision VALUES (?, ?, ?, ?)",
+            (image["image_hash"], VISION_MODEL, VISION_PROMPT_HASH, response.text)
+        )
+        cache.commit()
+    
+    return response.text
+
+async def _describe_images(images, cache):
+    """
+    Describes all images concurrently, with at most VISION_CONCURRENCY requests in flight
+    and no more than VISION_RPM requests per minute.
+    """
+    vision_model = genai.GenerativeModel(VISION_MODEL)
+    semaphore = asyncio.Semaphore(VISION_CONCURRENCY)
+    limiter = RateLimiter(VISION_RPM, 60)
+    
+    # return_exceptions keeps one failed image from cancelling the rest
+    return await asyncio.gather(
+        *[_describe_image(vision_model, semaphore, limiter, image, cache) for image in images],
+        return_exceptions=True
+    )
+
+def create_image_cards(image_data, cache=None):
     """
     Job 4: The AI Art Critic.
-    Uses Gemini Vision to create detailed text descriptions for each image.
+    Uses Gemini Vision to create detailed text descriptions for each image found by extract_pages.
+    Images already described in the cache (if one is given) aren't sent to Gemini again.
     Returns a list of "image cards," each containing the AI's description and metadata.
     """
     print("Creating image cards with AI descriptions...")
     
-    # Initialize the vision model
-    vision_model = genai.GenerativeModel(VISION_MODEL)
+    # Descriptions from earlier runs, keyed by image hash
+    descriptions = {}
+    if cache is not None:
+        descriptions = dict(cache.execute(
+            "SELECT image_hash, description FROM vision WHERE model = ? AND prompt_hash = ?",
+            (VISION_MODEL, VISION_PROMPT_HASH)
+        ))
+    
+    new_images = [item for item in image_data if item["image_hash"] not in descriptions]
+    if len(new_images) < len(image_data):
+        print(f"Reusing {len(image_data) - len(new_images)} image descriptions from the cache")
+    
+    results = asyncio.run(_describe_images(new_images, cache))
+    for item, result in zip(new_images, results):
+        descriptions[item["image_hash"]] = result
     
     image_cards = []
     
-    for image_path in image_paths:
-        try:
-            # Load the image
-            image = Image.open(image_path)
-            
-            # Create a medical-focused prompt
-            prompt = """You are a medical expert analyzing a medical image or diagram. 
-            Please provide a detailed description of what you see, including:
-            - Any anatomical structures visible
-            - Medical conditions or symptoms shown
-            - Diagnostic information or measurements
-            - Any text, labels, or captions in the image
-            - The type of medical image (X-ray, diagram, chart, etc.)
-            
-            Be precise and use medical terminology where appropriate."""
-            
-            # Get AI description
-            response = vision_model.generate_content([prompt, image])
-            description = response.text
-            
-            # Create image card
-            image_cards.append({
-                "content": description,
-                "metadata": {
-                    "source": "Oxford Handbook",
-                    "image_path": image_path,
-                    "type": "image"
-                }
-            })
-            
-            print(f"Processed image: {image_path}")
-            
-            # Add delay to respect API rate limits
-            time.sleep(1)
-            
-        except Exception as e:
-            print(f"Error processing image {image_path}: {e}")
+    for item in image_data:
+        description = descriptions[item["image_hash"]]
+        if isinstance(description, Exception):
+            print(f"Error processing image {item['image_id']}: {description}")
             continue
+        
+        # Create image card (ChromaDB metadata can't hold lists, so the pages are joined)
+        # One card per unique image, so every page showing it points to the same card id
+        image_cards.append({
+            "id": item["image_id"],
+            "content": description,
+            "metadata": {
+                "source": "Oxford Handbook",
+                "image_id": item["image_id"],
+                "page": item["pages"][0],
+                "pages": ",".join(str(page) for page in item["pages"]),
+                "type": "image"
+            }
+        })
     
     print(f"Created {len(image_cards)} image cards")
     return image_cards
 
-def store_cards_in_database(collection, cards, card_type):
+def embed_batch(texts, limiter, task_type="retrieval_document", model=EMBEDDING_MODEL):
+    """
+    Creates the "meaning coordinates" (embeddings) for a list of texts, EMBEDDING_BATCH_SIZE texts per API call,
+    pacing the calls with the given RateLimiter. Use task_type="retrieval_query" for search queries.
+    Returns them as a single float32 array with one row per text.
+    """
+    embeddings = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        embeddings.extend(_embed_request(texts[i:i + EMBEDDING_BATCH_SIZE], limiter, task_type, model))
+    
+    # One contiguous float32 array is half the size of float64 and far smaller than lists of Python floats
+    return np.asarray(embeddings, dtype=np.float32)
+
+def _embed_request(texts, limiter, task_type, model):
+    """Embeds one request's worth of texts, backing off and retrying when the quota is used up."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            with limiter:
+                response = genai.embed_content(
+                    model=model,
+                    content=texts,
+                    task_type=task_type
+                )
+            return response["embedding"]
+        except ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            wait = min(2 ** attempt, 60)
+            print(f"Embedding quota exceeded, retrying in {wait}s...")
+            time.sleep(wait)
+
+@register_embedding_function
+class GeminiEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Tells ChromaDB to embed with EMBEDDING_MODEL, the same model we embed the cards with.
+    It is saved in the collection's configuration, so searches with query_texts use the right
+    model (and anything opening the brain must import this module for ChromaDB to find it).
+    """
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._limiter = RateLimiter(EMBEDDING_RPM, 60)
+
+    def __call__(self, input):
+        return list(embed_batch(list(input), self._limiter, model=self.model_name))
+
+    def embed_query(self, input):
+        return list(embed_batch(list(input), self._limiter, task_type="retrieval_query", model=self.model_name))
+
+    @staticmethod
+    def name():
+        return "gemini_text_embedding"
+
+    def get_config(self):
+        return {"model_name": self.model_name}
+
+    @staticmethod
+    def build_from_config(config):
+        return GeminiEmbeddingFunction(config["model_name"])
+
+    def default_space(self):
+        return "cosine"
+
+def store_cards_in_database(client, collection, cards, card_type):
     """
     Job 5: The Final Filer.
     Takes a list of cards (text or image), creates their "meaning coordinates" (embeddings),
-    and stores them permanently in our database.
+    and stores them permanently in our database, each under its card's "id".
+    Cards already in the database (e.g. from a run that crashed later on) are skipped without being embedded again.
     """
     print(f"Storing {len(cards)} {card_type} cards in database...")
     
-    # Process in batches to avoid API limits
-    batch_size = 100
+    if not cards:
+        return
+    
+    # Use the biggest batches ChromaDB accepts, every collection.add is a database transaction
+    batch_size = min(client.get_max_batch_size(), len(cards))
+    # Embedding requests run at full speed until the per-minute quota runs out
+    limiter = RateLimiter(EMBEDDING_RPM, 60)
     
     for i in range(0, len(cards), batch_size):
         batch = cards[i:i + batch_size]
         
+        # Skip cards stored by an earlier run, ChromaDB would drop them anyway after we paid to embed them
+        existing_ids = set(collection.get(ids=[card["id"] for card in batch], include=[])["ids"])
+        batch = [card for card in batch if card["id"] not in existing_ids]
+        if not batch:
+            print(f"Batch {i//batch_size + 1} of {card_type} cards is already stored")
+            continue
+        
         # Prepare data for ChromaDB
         documents = []
         metadatas = []
         ids = []
         
-        for j, card in enumerate(batch):
+        for card in batch:
             documents.append(card["content"])
             metadatas.append(card["metadata"])
-            ids.append(f"{card_type}_{i + j}")
+            ids.append(card["id"])
         
-        # Add to collection (ChromaDB will handle embedding generation)
+        # Embed the whole batch ourselves instead of letting ChromaDB embed one document at a time
+        embeddings = embed_batch(documents, limiter)
+        
+        # Add to collection
         collection.add(
+            embeddings=embeddings,
             documents=documents,
             metadatas=metadatas,
             ids=ids
         )
         
         print(f"Stored batch {i//batch_size + 1} of {card_type} cards")
-        
-        # Add delay between batches
-        time.sleep(0.5)
     
     print(f"Successfully stored all {card_type} cards")
 
@@ -256,20 +578,24 @@ if __name__ == "__main__":
     
     genai.configure(api_key=api_key)
 
-    # Step 1: Set up the database
-    db_collection = initialize_database()
+    # Step 1: Set up the database, and the cache of work finished by earlier runs
+    db_client, db_collection = initialize_database()
+    build_cache = open_cache(CACHE_PATH)
+
+    # Step 2: Read the PDF once for both its text and its images
+    print("\n--- Reading the PDF ---")
+    raw_text_data, raw_image_data = extract_pages(PDF_FILE_PATH, IMAGE_OUTPUT_FOLDER if SAVE_IMAGES else None, build_cache)
 
     # --- Text Processing Pipeline ---
     print("\n--- Processing TEXT from the PDF ---")
-    raw_text_data = extract_text_from_pdf(PDF_FILE_PATH)
     text_cards = create_text_cards(raw_text_data)
-    store_cards_in_database(db_collection, text_cards, card_type="text")
+    store_cards_in_database(db_client, db_collection, text_cards, card_type="text")
 
     # --- Image Processing Pipeline ---
     print("\n--- Processing IMAGES from the PDF ---")
-    image_file_paths = extract_images_from_pdf(PDF_FILE_PATH, IMAGE_OUTPUT_FOLDER)
-    image_cards = create_image_cards(image_file_paths)
-    store_cards_in_database(db_collection, image_cards, card_type="image")
+    image_cards = create_image_cards(raw_image_data, build_cache)
+    store_cards_in_database(db_client, db_collection, image_cards, card_type="image")
+    build_cache.close()
 
     print("\n>>> OFFLINE BUILD PROCESS COMPLETE! <<<")
     print(f"The 'brain' is ready and stored in the '{DB_PATH}' folder.")